@@ -1,12 +1,22 @@
 import os
-import requests
-import json
+import asyncio
+import httpx
+import ijson
+import hashlib
+import orjson
 import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from itertools import chain
+from urllib.parse import urlencode
 from datetime import datetime
 from typing import Optional
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
+from reporter_core import calculate_leads_and_cpl, is_lead_action, parse_ad_name
 
 # 設定日誌
 logging.basicConfig(
@@ -15,11 +25,18 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Graph API 單一 batch 請求最多可包含的子請求數
+_BATCH_LIMIT = 50
+
+# Graph API 回應快取（帳戶列表與 insights 分頁），以 token 雜湊值區分使用者
+_response_cache = TTLCache(maxsize=1024, ttl=300)
+
 # FastAPI 應用程式初始化
 app = FastAPI(
     title="Meta Ads Reporter API",
     version="1.0.0",
-    description="Meta 廣告數據報告 API"
+    description="Meta 廣告數據報告 API",
+    default_response_class=ORJSONResponse
 )
 
 # 加入 CORS 支援
@@ -44,37 +61,54 @@ class AdsReportResponse(BaseModel):
     data: Optional[dict] = None
     error: Optional[str] = None
 
+# 單一廣告的報告資料列；廣告數量多，使用 slots 減少每筆資料的記憶體
+@dataclass(slots=True)
+class AdRow:
+    account_name: str
+    account_id: str
+    ad_name: str
+    ad_id: str
+    spend: int
+    leads: int
+    cpl: int
+
 class MetaAdsReporter:
     def __init__(self, access_token):
         self.access_token = access_token
         self.base_url = "https://graph.facebook.com/v18.0"
         self.logger = logging.getLogger(f"{__name__}.MetaAdsReporter")
-        
-        # 分級規則定義
-        self.grade_rules = {
-            "課程": "R", "求職": "R", "懶人包": "N", "素材": "N", "優惠": "R",
-            "接案": "R", "諮詢": "R", "小遊戲": "C", "職能講座": "SR", "職能工作坊": "SR",
-            "軟實力講座": "R", "軟實力工作坊": "R", "培訓營": "SR", "互動測驗": "C",
-            "實習": "N", "自來客": "SSR", "社群互動": "C"
-        }
-        
-    def get_ad_accounts(self):
+        self.client = httpx.AsyncClient(
+            http2=True,
+            timeout=30,
+            limits=httpx.Limits(max_keepalive_connections=32)
+        )
+        self._token_key = hashlib.blake2b(access_token.encode(), digest_size=16).hexdigest()
+    
+    async def close(self):
+        await self.client.aclose()
+    
+    async def get_ad_accounts(self):
         url = f"{self.base_url}/me/adaccounts"
         params = {
             'access_token': self.access_token,
             'fields': 'id,name,account_status'
         }
         
+        cache_key = (self._token_key, 'accounts')
+        if cache_key in _response_cache:
+            return _response_cache[cache_key]
+        
         self.logger.info(f"🔍 Fetching ad accounts from Meta API")
         
-        response = requests.get(url, params=params, timeout=30)
+        response = await self.client.get(url, params=params)
         
         if response.status_code == 200:
-            data = response.json().get('data', [])
+            data = orjson.loads(response.content).get('data', [])
             self.logger.info(f"✅ Found {len(data)} ad accounts")
+            _response_cache[cache_key] = data
             return data
         else:
-            error_data = response.json().get('error', {})
+            error_data = orjson.loads(response.content).get('error', {})
             error_code = error_data.get('code', 'Unknown')
             error_message = error_data.get('message', response.text)
             
@@ -85,289 +119,263 @@ class MetaAdsReporter:
             else:
                 raise Exception(f"Meta API 錯誤 (Code: {error_code}): {error_message}")
     
-    def get_ads_insights(self, ad_account_id, date_start, date_end):
-        url = f"{self.base_url}/{ad_account_id}/insights"
-        
-        params = {
+    async def _post_batch(self, batch):
+        data = {
             'access_token': self.access_token,
-            'level': 'ad',
-            'fields': 'ad_name,ad_id,spend,actions,cost_per_action_type',
-            'time_range': json.dumps({
-                'since': date_start,
-                'until': date_end
-            }),
-            'limit': 500
+            'batch': orjson.dumps(batch).decode()
         }
         
-        self.logger.info(f"📊 Fetching insights for account {ad_account_id}")
+        pages = []
+        sub_responses = ijson.sendable_list()
+        parser = ijson.items_coro(sub_responses, 'item')
         
-        all_ads = []
-        
-        while True:
-            response = requests.get(url, params=params, timeout=30)
+        async with self.client.stream('POST', f"{self.base_url}/", data=data) as response:
+            if response.status_code != 200:
+                self.logger.warning(f"Batch request failed with status {response.status_code}")
+                return [None] * len(batch)
             
-            if response.status_code == 200:
-                data = response.json()
-                ads_data = data.get('data', [])
-                all_ads.extend(ads_data)
-                
-                if 'paging' in data and 'next' in data['paging']:
-                    url = data['paging']['next']
-                    params = {}
-                else:
-                    break
-            else:
-                self.logger.warning(f"Failed to get insights for {ad_account_id}")
-                break
+            # 邊接收邊解析 batch 回應陣列，子回應的 body 一到就解析，不保留整份原始回應
+            async for chunk in response.aiter_bytes():
+                parser.send(chunk)
+                pages.extend(self._parse_sub_response(sub_response) for sub_response in sub_responses)
+                del sub_responses[:]
+        
+        parser.close()
+        pages.extend(self._parse_sub_response(sub_response) for sub_response in sub_responses)
         
-        self.logger.info(f"✅ Total ads fetched: {len(all_ads)}")
-        return all_ads
+        return pages
     
-    def calculate_leads_and_cpl(self, ad_data):
-        spend = float(ad_data.get('spend', 0))
-        leads = 0
-        cpl = 0
+    def _parse_sub_response(self, sub_response):
+        if not sub_response or sub_response.get('code') != 200:
+            return None
         
-        actions = ad_data.get('actions', [])
+        data = orjson.loads(sub_response['body'])
         
-        # 優先順序：
-        # 1. offsite_conversion.fb_pixel_custom (包含 Submit 或 SurveyCake)
-        # 2. lead
+        # 只保留計算名單會用到的 action types，其餘（點擊、觀看等）不進快取也不往下傳
+        for ad_data in data.get('data', []):
+            for key in ('actions', 'cost_per_action_type'):
+                if key in ad_data:
+                    ad_data[key] = [
+                        action for action in ad_data[key]
+                        if is_lead_action(action.get('action_type', ''))
+                    ]
         
-        # 先檢查是否有 custom conversion
-        custom_conversion_found = False
-        for action in actions:
-            action_type = action.get('action_type', '')
+        return data
+    
+    def _page_request(self, account_id, params, after=None):
+        # 分頁一律用原始參數加上 after cursor 組成相對路徑，網址中不含 token
+        page_params = dict(params, after=after) if after else params
+        return after, f"{account_id}/insights?{urlencode(page_params)}"
+    
+    def _next_cursor(self, data):
+        paging = data.get('paging', {})
+        
+        if not paging.get('next'):
+            return None
+        return paging.get('cursors', {}).get('after')
+    
+    def _follow_cached_pages(self, account_id, data, params, date_start, date_end, to_fetch):
+        # 從目前頁面開始沿著已快取的後續頁面前進，第一個未命中的頁面加入 to_fetch
+        pages = [data]
+        after = self._next_cursor(data)
+        
+        while after:
+            data = _response_cache.get((self._token_key, account_id, date_start, date_end, after))
             
-            # 檢查 custom conversion
-            if action_type == 'offsite_conversion.fb_pixel_custom':
-                # 可能需要檢查 action_destination 或其他欄位來確認是否為 Submit 類型
-                leads = int(action.get('value', 0))
-                custom_conversion_found = True
-                self.logger.debug(f"Found custom conversion: {leads} leads")
+            if data is None:
+                to_fetch.append((account_id, self._page_request(account_id, params, after)))
                 break
+            
+            pages.append(data)
+            after = self._next_cursor(data)
         
-        # 如果沒有 custom conversion，才找 lead
-        if not custom_conversion_found:
-            for action in actions:
-                action_type = action.get('action_type', '')
-                
-                if action_type == 'lead':
-                    leads = int(action.get('value', 0))
-                    self.logger.debug(f"Found standard lead: {leads} leads")
-                    break
-        
-        # 如果還是沒找到，檢查其他 lead 相關的 action types
-        if leads == 0:
-            for action in actions:
-                action_type = action.get('action_type', '')
-                
-                if action_type in [
-                    'offsite_conversion.fb_pixel_lead',
-                    'onsite_conversion.lead_grouped',
-                    'leadgen_grouped'
-                ] or ('lead' in action_type.lower() and action_type != 'lead'):
-                    leads += int(action.get('value', 0))
-                    self.logger.debug(f"Found other lead type {action_type}: {action.get('value', 0)} leads")
-        
-        # 如果完全沒有找到 lead，嘗試從 cost_per_action_type 推算
-        if leads == 0:
-            cost_per_actions = ad_data.get('cost_per_action_type', [])
-            for cpa in cost_per_actions:
-                action_type = cpa.get('action_type', '')
+        return [(account_id, page_data) for page_data in pages]
+    
+    async def _fetch_pages(self, to_fetch, date_start, date_end):
+        chunks = [to_fetch[i:i + _BATCH_LIMIT] for i in range(0, len(to_fetch), _BATCH_LIMIT)]
+        
+        results = await asyncio.gather(*[
+            self._post_batch([
+                {'method': 'GET', 'relative_url': relative_url}
+                for _, (_, relative_url) in chunk
+            ])
+            for chunk in chunks
+        ])
+        
+        fetched = []
+        
+        for chunk, pages in zip(chunks, results):
+            for (account_id, (cursor, _)), data in zip(chunk, pages):
+                if data is None:
+                    self.logger.warning(f"Failed to get insights for {account_id}")
+                    continue
                 
-                # 同樣的優先順序
-                if action_type == 'offsite_conversion.fb_pixel_custom':
-                    cpl_value = float(cpa.get('value', 0))
-                    if cpl_value > 0:
-                        leads = int(spend / cpl_value)
-                        self.logger.debug(f"Calculated from custom CPL: {leads} leads")
-                        break
-            
-            # 如果沒有 custom，找 lead
-            if leads == 0:
-                for cpa in cost_per_actions:
-                    if cpa.get('action_type', '') == 'lead':
-                        cpl_value = float(cpa.get('value', 0))
-                        if cpl_value > 0:
-                            leads = int(spend / cpl_value)
-                            self.logger.debug(f"Calculated from standard CPL: {leads} leads")
-                            break
-        
-        # 計算 CPL
-        if leads > 0:
-            cpl = spend / leads
-        
-        return leads, int(cpl)
+                _response_cache[(self._token_key, account_id, date_start, date_end, cursor)] = data
+                fetched.append((account_id, data))
+        
+        return fetched
     
-    def parse_ad_name(self, ad_name):
-        try:
-            parts = ad_name.split('/')
-            
-            if len(parts) < 3:
-                return None
-            
-            page_name = parts[0]
-            middle_part = parts[1]
+    async def iter_insights_pages(self, account_ids, date_start, date_end):
+        params = {
+            'level': 'ad',
+            'fields': 'ad_name,ad_id,spend,actions{action_type,value},cost_per_action_type{action_type,value}',
+            'time_range': orjson.dumps({
+                'since': date_start,
+                'until': date_end
+            }).decode(),
+            'limit': 1000
+        }
+        
+        self.logger.info(f"📊 Fetching insights for {len(account_ids)} accounts via batch requests")
+        
+        ready = []
+        to_fetch = []
+        
+        # 已快取的頁面直接使用，只有第一個未命中的頁面才需要發出請求
+        for account_id in account_ids:
+            data = _response_cache.get((self._token_key, account_id, date_start, date_end, None))
             
-            if '_' in middle_part:
-                field_and_type = middle_part.split('_')
-                field = field_and_type[0]
-                
-                if '-' in field_and_type[1]:
-                    ad_type = field_and_type[1].split('-')[0]
-                else:
-                    ad_type = field_and_type[1]
+            if data is None:
+                to_fetch.append((account_id, self._page_request(account_id, params)))
             else:
-                field = middle_part
-                ad_type = "未分類"
-            
-            # 檢查是否有明確的等級標記（如：課程N, 求職SR）
-            grade = None
-            grade_markers = ['SSR', 'SR', 'R', 'N', 'C', 'D']
+                ready.extend(self._follow_cached_pages(account_id, data, params, date_start, date_end, to_fetch))
+        
+        # 每一輪把所有還有下一頁的帳戶合併成 batch 請求，直到沒有帳戶需要翻頁
+        while ready or to_fetch:
+            # 先發出下一輪請求，再把本輪頁面交給呼叫端處理，讓網路等待與資料處理重疊
+            fetch_task = asyncio.create_task(
+                self._fetch_pages(to_fetch, date_start, date_end)
+            ) if to_fetch else None
             
-            for marker in grade_markers:
-                if ad_type.endswith(marker):
-                    # 提取等級並移除等級標記
-                    grade = marker
-                    ad_type = ad_type[:-len(marker)]
-                    break
+            for page in ready:
+                yield page
             
-            # 如果沒有明確標記，使用預設規則
-            if grade is None:
-                grade = self.grade_rules.get(ad_type, "D")
+            ready, to_fetch = [], []
             
-            employee_part = parts[-1]
-            employees = employee_part.split('+') if '+' in employee_part else [employee_part]
-            
-            return {
-                'page_name': page_name,
-                'field': field,
-                'ad_type': ad_type,
-                'grade': grade,
-                'employees': employees,
-                'employee_key': '+'.join(sorted(employees))
-            }
-            
-        except Exception:
-            return None
+            if fetch_task is not None:
+                for account_id, data in await fetch_task:
+                    ready.extend(self._follow_cached_pages(account_id, data, params, date_start, date_end, to_fetch))
+    
+    def calculate_leads_and_cpl(self, ad_data):
+        return calculate_leads_and_cpl(ad_data)
+    
+    def parse_ad_name(self, ad_name):
+        return parse_ad_name(ad_name)
     
     def generate_employee_summary(self, ads_data):
-        employee_stats = {}
+        # 以 (員工, 等級, 領域) 為單一鍵累計 [花費, 名單數, 廣告數]，解析廣告名稱時順便加總
+        field_stats = defaultdict(lambda: [0, 0, 0])
         
         for ad in ads_data:
-            parsed = self.parse_ad_name(ad['ad_name'])
+            parsed = self.parse_ad_name(ad.ad_name)
             
             if not parsed:
                 continue
             
-            employee_key = parsed['employee_key']
-            
+            stats = field_stats[(parsed.employee_key, parsed.grade, parsed.field)]
+            stats[0] += ad.spend
+            stats[1] += ad.leads
+            stats[2] += 1
+        
+        employee_stats = {}
+        
+        for (employee_key, grade, field), (total_spend, total_leads, ads_count) in field_stats.items():
             if employee_key not in employee_stats:
                 employee_stats[employee_key] = {
                     '員工': employee_key,
-                    'SSR等級花費': {},
-                    'SR等級花費': {},
-                    'R等級花費': {},
-                    'N等級花費': {},
-                    'C等級花費': {},
-                    'D等級花費': {}
+                    'SSR等級花費': [],
+                    'SR等級花費': [],
+                    'R等級花費': [],
+                    'N等級花費': [],
+                    'C等級花費': [],
+                    'D等級花費': []
                 }
             
-            grade = parsed['grade']
-            field = parsed['field']
-            grade_key = f"{grade}等級花費"
+            avg_cpl = int(total_spend / total_leads) if total_leads > 0 else 0
             
-            if field not in employee_stats[employee_key][grade_key]:
-                employee_stats[employee_key][grade_key][field] = {
-                    'total_spend': 0,
-                    'total_leads': 0,
-                    'ads_count': 0
-                }
-            
-            field_stats = employee_stats[employee_key][grade_key][field]
-            field_stats['total_spend'] += ad['spend']
-            field_stats['total_leads'] += ad['leads']
-            field_stats['ads_count'] += 1
+            employee_stats[employee_key][f"{grade}等級花費"].append(
+                f"{field},average_cpl:{avg_cpl},total_spend:{int(total_spend)},"
+                f"total_leads:{total_leads},ads_count:{ads_count}"
+            )
         
-        summary_list = []
+        return list(employee_stats.values())
+    
+    def _build_ad_rows(self, account, ads_insights):
+        account_id = account['id']
+        account_name = account.get('name', 'Unknown')
+        rows = []
         
-        for employee_key, stats in employee_stats.items():
-            formatted_stats = {'員工': stats['員工']}
+        for ad_data in ads_insights:
+            leads, cpl = self.calculate_leads_and_cpl(ad_data)
             
-            for grade in ['SSR等級花費', 'SR等級花費', 'R等級花費', 'N等級花費', 'C等級花費', 'D等級花費']:
-                grade_data = []
-                
-                if grade in stats and stats[grade]:
-                    for field, field_stats in stats[grade].items():
-                        if field_stats['ads_count'] > 0:
-                            avg_cpl = int(field_stats['total_spend'] / field_stats['total_leads']) if field_stats['total_leads'] > 0 else 0
-                            
-                            grade_data.append(
-                                f"{field},average_cpl:{avg_cpl},total_spend:{int(field_stats['total_spend'])},"
-                                f"total_leads:{field_stats['total_leads']},ads_count:{field_stats['ads_count']}"
-                            )
-                
-                formatted_stats[grade] = grade_data if grade_data else []
-            
-            summary_list.append(formatted_stats)
-        
-        return summary_list
+            rows.append(AdRow(
+                account_name=account_name,
+                account_id=account_id,
+                ad_name=ad_data.get('ad_name', 'Unknown'),
+                ad_id=ad_data.get('ad_id', ''),
+                spend=int(float(ad_data.get('spend', 0))),
+                leads=leads,
+                cpl=int(cpl) if cpl > 0 else 0
+            ))
+        
+        return rows
     
-    def generate_report(self, date_start, date_end):
+    async def generate_report(self, date_start, date_end):
         self.logger.info(f"🚀 Starting report generation: {date_start} to {date_end}")
         
-        ad_accounts = self.get_ad_accounts()
+        all_ads_data = await self.fetch_ads_data(date_start, date_end)
+        
+        # 彙總是純 CPU 運算，移到執行緒中執行，避免阻塞其他報告請求
+        return await asyncio.to_thread(self._aggregate, all_ads_data, date_start, date_end)
+    
+    async def fetch_ads_data(self, date_start, date_end):
+        ad_accounts = await self.get_ad_accounts()
         
         if not ad_accounts:
-            return self._empty_report(date_start, date_end)
+            return []
         
-        all_ads_data = []
+        accounts = {account['id']: account for account in ad_accounts}
+        page_rows_by_account = {account_id: [] for account_id in accounts}
         
-        for account in ad_accounts:
-            account_id = account['id']
-            account_name = account.get('name', 'Unknown')
-            
-            ads_insights = self.get_ads_insights(account_id, date_start, date_end)
-            
-            for ad_data in ads_insights:
-                leads, cpl = self.calculate_leads_and_cpl(ad_data)
-                
-                ad_info = {
-                    'account_name': account_name,
-                    'account_id': account_id,
-                    'ad_name': ad_data.get('ad_name', 'Unknown'),
-                    'ad_id': ad_data.get('ad_id', ''),
-                    'spend': int(float(ad_data.get('spend', 0))),
-                    'leads': leads,
-                    'cpl': int(cpl) if cpl > 0 else 0
-                }
-                
-                all_ads_data.append(ad_info)
+        # 所有帳戶的 insights 以 batch 請求取得；每一頁的廣告交給執行緒轉換，
+        # 事件迴圈同時等待下一輪分頁的回應
+        async for account_id, data in self.iter_insights_pages(list(accounts), date_start, date_end):
+            page_rows_by_account[account_id].append(
+                await asyncio.to_thread(self._build_ad_rows, accounts[account_id], data.get('data', []))
+            )
         
-        total_spend = sum(ad['spend'] for ad in all_ads_data)
-        total_leads = sum(ad['leads'] for ad in all_ads_data)
-        avg_cpl = total_spend / total_leads if total_leads > 0 else 0
+        # 依帳戶順序一次攤平所有頁面的資料列
+        return list(chain.from_iterable(
+            chain.from_iterable(page_rows_by_account.values())
+        ))
+    
+    def _aggregate(self, all_ads_data, date_start, date_end):
+        if not all_ads_data:
+            return self._empty_report(date_start, date_end)
         
+        # AdRow 直接以屬性讀取，只走訪一次，不再轉回 dict 或 DataFrame
         by_account = {}
         for ad in all_ads_data:
-            account_name = ad['account_name']
-            if account_name not in by_account:
-                by_account[account_name] = {
-                    'account_id': ad['account_id'],
+            if ad.account_name not in by_account:
+                by_account[ad.account_name] = {
+                    'account_id': ad.account_id,
                     'total_spend': 0,
                     'total_leads': 0,
                     'ads_count': 0
                 }
-            by_account[account_name]['total_spend'] += ad['spend']
-            by_account[account_name]['total_leads'] += ad['leads']
-            by_account[account_name]['ads_count'] += 1
+            account = by_account[ad.account_name]
+            account['total_spend'] += ad.spend
+            account['total_leads'] += ad.leads
+            account['ads_count'] += 1
         
         for account in by_account.values():
             account['average_cpl'] = int(
                 account['total_spend'] / account['total_leads']
             ) if account['total_leads'] > 0 else 0
-            account['total_spend'] = int(account['total_spend'])
+        
+        total_spend = sum(account['total_spend'] for account in by_account.values())
+        total_leads = sum(account['total_leads'] for account in by_account.values())
+        avg_cpl = total_spend / total_leads if total_leads > 0 else 0
         
         employee_summary = self.generate_employee_summary(all_ads_data)
         
@@ -410,7 +418,7 @@ class MetaAdsReporter:
             'ads_detail': []
         }
 
-@app.post("/report", response_model=AdsReportResponse)
+@app.post("/report", response_model=AdsReportResponse, response_class=ORJSONResponse)
 async def generate_ads_report(request: AdsReportRequest):
     """
     生成 Meta 廣告報告
@@ -428,13 +436,18 @@ async def generate_ads_report(request: AdsReportRequest):
         
         # 生成報告
         reporter = MetaAdsReporter(request.access_token)
-        report = reporter.generate_report(request.date_start, request.date_end)
-        
-        return AdsReportResponse(
-            success=True,
-            message=f"成功生成報告，共找到 {report['summary']['total_ads']} 個廣告",
-            data=report
-        )
+        try:
+            report = await reporter.generate_report(request.date_start, request.date_end)
+        finally:
+            await reporter.close()
+        
+        # 報告可能包含數千筆廣告明細，直接以 orjson 輸出，略過 pydantic 的驗證與轉換
+        return ORJSONResponse({
+            'success': True,
+            'message': f"成功生成報告，共找到 {report['summary']['total_ads']} 個廣告",
+            'data': report,
+            'error': None
+        })
     
     except ValueError:
         return AdsReportResponse(
@@ -0,0 +1,162 @@
+# 每筆廣告都會呼叫的純運算函式，獨立成模組以便在建置時用 mypyc 編譯；
+# 沒有編譯版本時直接以純 Python 執行
+import logging
+import re
+import types
+from functools import lru_cache
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 沒有 custom conversion 與 lead 時，改為加總的其他 lead 相關 action types
+_OTHER_LEAD_ACTION_TYPES = (
+    'offsite_conversion.fb_pixel_lead',
+    'onsite_conversion.lead_grouped',
+    'leadgen_grouped'
+)
+
+# 分級規則定義（唯讀，所有請求共用）
+_GRADE_RULES = types.MappingProxyType({
+    "課程": "R", "求職": "R", "懶人包": "N", "素材": "N", "優惠": "R",
+    "接案": "R", "諮詢": "R", "小遊戲": "C", "職能講座": "SR", "職能工作坊": "SR",
+    "軟實力講座": "R", "軟實力工作坊": "R", "培訓營": "SR", "互動測驗": "C",
+    "實習": "N", "自來客": "SSR", "社群互動": "C"
+})
+
+# 等級標記必須位於廣告類型結尾；SSR 排在 SR 之前，確保優先比對較長的標記
+_GRADE_MARKERS = ('SSR', 'SR', 'R', 'N', 'C', 'D')
+_GRADE_RE = re.compile(f"(.*?)({'|'.join(_GRADE_MARKERS)})", re.DOTALL)
+
+# 廣告名稱解析結果；快取會共用同一個物件，因此必須是不可變的
+class ParsedAdName(NamedTuple):
+    page_name: str
+    field: str
+    ad_type: str
+    grade: str
+    employees: Tuple[str, ...]
+    employee_key: str
+
+# calculate_leads_and_cpl 會用到的 action type；其他類型可在解析時先丟棄。
+# 新增 lead 類型時必須同步更新這裡，否則資料在計算前就會被濾掉
+def is_lead_action(action_type: str) -> bool:
+    return (
+        action_type == 'offsite_conversion.fb_pixel_custom'
+        or action_type == 'lead'
+        or action_type in _OTHER_LEAD_ACTION_TYPES
+        or 'lead' in action_type.lower()
+    )
+
+def calculate_leads_and_cpl(ad_data: Dict[str, Any]) -> Tuple[int, int]:
+    spend: float = float(ad_data.get('spend', 0))
+    cpl: float = 0.0
+    leads: int
+    
+    # 一次走訪建立 action_type -> 數值 的對照表，之後依優先順序查表
+    actions_map: Dict[str, int] = {
+        action.get('action_type', ''): int(action.get('value', 0))
+        for action in ad_data.get('actions', [])
+    }
+    
+    # 優先順序：
+    # 1. offsite_conversion.fb_pixel_custom (包含 Submit 或 SurveyCake)
+    # 2. lead
+    if 'offsite_conversion.fb_pixel_custom' in actions_map:
+        # 可能需要檢查 action_destination 或其他欄位來確認是否為 Submit 類型
+        leads = actions_map['offsite_conversion.fb_pixel_custom']
+        logger.debug(f"Found custom conversion: {leads} leads")
+    else:
+        leads = actions_map.get('lead', 0)
+    
+    # 如果還是沒找到，加總其他 lead 相關的 action types
+    if leads == 0:
+        leads = sum(
+            value for action_type, value in actions_map.items()
+            if action_type in _OTHER_LEAD_ACTION_TYPES
+            or ('lead' in action_type.lower() and action_type != 'lead')
+        )
+    
+    # 如果完全沒有找到 lead，嘗試從 cost_per_action_type 推算（同樣的優先順序）
+    if leads == 0:
+        cost_map: Dict[str, float] = {
+            cpa.get('action_type', ''): float(cpa.get('value', 0))
+            for cpa in ad_data.get('cost_per_action_type', [])
+        }
+        
+        for action_type in ('offsite_conversion.fb_pixel_custom', 'lead'):
+            cpl_value: float = cost_map.get(action_type, 0.0)
+            if cpl_value > 0:
+                leads = int(spend / cpl_value)
+                logger.debug(f"Calculated from {action_type} CPL: {leads} leads")
+            if leads > 0:
+                break
+    
+    # 計算 CPL
+    if leads > 0:
+        cpl = spend / leads
+    
+    return leads, int(cpl)
+
+@lru_cache(maxsize=65536)
+def parse_ad_name(ad_name: Optional[str]) -> Optional[ParsedAdName]:
+    # 編譯後的版本會在進入函式前檢查參數型別，非字串必須在這裡先擋下
+    if not isinstance(ad_name, str):
+        return None
+    
+    try:
+        parts = ad_name.split('/')
+        
+        if len(parts) < 3:
+            return None
+        
+        page_name: str = parts[0]
+        middle_part: str = parts[1]
+        field: str
+        ad_type: str
+        
+        if '_' in middle_part:
+            field_and_type = middle_part.split('_')
+            field = field_and_type[0]
+            
+            if '-' in field_and_type[1]:
+                ad_type = field_and_type[1].split('-')[0]
+            else:
+                ad_type = field_and_type[1]
+        else:
+            field = middle_part
+            ad_type = "未分類"
+        
+        # 檢查是否有明確的等級標記（如：課程N, 求職SR）
+        grade: Optional[str] = None
+        match = _GRADE_RE.fullmatch(ad_type)
+        
+        if match:
+            # 提取等級並移除等級標記
+            ad_type, grade = match.group(1), match.group(2)
+        
+        # 如果沒有明確標記，使用預設規則
+        if grade is None:
+            grade = _GRADE_RULES.get(ad_type, "D")
+        
+        employee_part: str = parts[-1]
+        employees: Tuple[str, ...]
+        employee_key: str
+        
+        # 大多數廣告只有一位員工，不需要拆分與排序
+        if '+' in employee_part:
+            employees = tuple(employee_part.split('+'))
+            employee_key = '+'.join(sorted(employees))
+        else:
+            employees = (employee_part,)
+            employee_key = employee_part
+        
+        return ParsedAdName(
+            page_name=page_name,
+            field=field,
+            ad_type=ad_type,
+            grade=grade,
+            employees=employees,
+            employee_key=employee_key
+        )
+    
+    except Exception:
+        return None